@@ -15,79 +15,206 @@ CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFT
 SOFTWARE.
 """
 import asyncio
-import warnings
+import atexit
+import threading
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 import aiohttp
+import numpy as np
+import shapely
 from bro import CPTCharacteristics
-from shapely.geometry.point import Point as SPPoint
 from shapely.geometry.polygon import Polygon as SPPolygon
 
-from viktor.utils import memoize
+from .caching import add_to_bounded_cache
 
 CPT_OBJECT_URL = "https://publiek.broservices.nl/sr/cpt/v1/objects/"
+MAX_CONCURRENT_REQUESTS = 16  # per host, both for the connection pool and the number of requests in flight
+MAX_CACHED_CPT_OBJECTS = 512
+MAX_CACHED_CPT_OBJECT_SIZE = 1_000_000  # bytes, larger CPT objects are always retrieved again
+RUNNER_CLOSE_TIMEOUT = 5  # seconds
+REQUEST_TIMEOUT = 10  # seconds, per request, the same limit as the requests to the BRO made by the bro package
 
+# Retrieved CPT objects, keyed by BRO id. A CPT object does not change once it is registered
+_CPT_OBJECTS: Dict[str, Optional[bytes]] = {}
+_CPT_OBJECTS_LOCK = threading.Lock()  # Only held to look up or store CPT objects, never during a request
 
-def filter_available_cpts(params, cpts: List[CPTCharacteristics]) -> List[Dict]:
+_RUNNER: Optional[asyncio.Runner] = None
+_RUNNER_LOCK = threading.Lock()  # CPT objects can be retrieved from several threads, but a Runner is not thread-safe
+_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def filter_available_cpts(params, cpts: List[CPTCharacteristics]) -> Dict[str, list]:
     """
     Filters available CPTs based on the given GeoPolygon in step 1.
     Necessary since the BRO only allows for square areas in case the type is Envelope.
+    The BRO ids, coordinates and dates of the CPTs inside the polygon are returned as separate, aligned lists.
     """
-    polygon = SPPolygon([(p.lat, p.lon) for p in params.step_1.geo_polygon.points])
-
-    filtered_cpts = []
-    for cpt in cpts:
-        _p = SPPoint(cpt.wgs84_coordinate.lat, cpt.wgs84_coordinate.lon)
-        if _p.within(polygon):
-            filtered_cpts.append(
-                {
-                    "bro_id": cpt.bro_id,
-                    "lat": cpt.wgs84_coordinate.lat,
-                    "lon": cpt.wgs84_coordinate.lon,
-                    "date": cpt.start_time,
-                }
-            )
-    return filtered_cpts
+    points = params.step_1.geo_polygon.points
+    coordinates = np.fromiter(((p.lat, p.lon) for p in points), dtype=np.dtype((np.float64, 2)), count=len(points))
+    polygon = SPPolygon(coordinates)
+    shapely.prepare(polygon)  # builds the edge index once, which is reused for every point tested
+
+    lats = np.fromiter((cpt.wgs84_coordinate.lat for cpt in cpts), dtype=np.float64, count=len(cpts))
+    lons = np.fromiter((cpt.wgs84_coordinate.lon for cpt in cpts), dtype=np.float64, count=len(cpts))
+
+    # Discard everything outside the bounding box first, so only the remaining candidates are tested on the polygon
+    min_lat, min_lon, max_lat, max_lon = polygon.bounds
+    candidates = np.flatnonzero((lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon))
+    inside = candidates[shapely.contains_xy(polygon, lats[candidates], lons[candidates])]
+
+    return {
+        "bro_ids": [cpts[i].bro_id for i in inside.tolist()],
+        "lats": lats[inside].tolist(),
+        "lons": lons[inside].tolist(),
+        "dates": [cpts[i].start_time for i in inside.tolist()],
+    }
 
 
-@memoize
-def get_cpt_object_xml_async(bro_cpt_ids: List[str]):
+def get_cpt_object_xml_async(bro_cpt_ids: List[str]) -> List[Optional[bytes]]:
     """
     Retrieves a list of cpt objects in bytes format asynchronously.
+    CPT objects that have been retrieved before are taken from the cache, only the others are requested from the BRO.
+    Cached CPT objects never wait for requests of another thread. Uncached ones wait for the retrieval in another
+    thread to finish first, so CPT objects that were being prefetched in the meantime are taken from the cache as well.
+    """
+    xml_bytes = _get_cached_cpt_objects(bro_cpt_ids)
+    if any(cpt_id not in xml_bytes for cpt_id in bro_cpt_ids):
+        with _RUNNER_LOCK:
+            xml_bytes.update(_get_cached_cpt_objects(bro_cpt_ids))
+            uncached_cpt_ids = [cpt_id for cpt_id in dict.fromkeys(bro_cpt_ids) if cpt_id not in xml_bytes]
+            if uncached_cpt_ids:
+                retrieved_xml_bytes = _get_runner().run(_async_get_xml_bytes_of_bro_cpt(uncached_cpt_ids))
+                xml_bytes.update(zip(uncached_cpt_ids, retrieved_xml_bytes))
+                _cache_cpt_objects(zip(uncached_cpt_ids, retrieved_xml_bytes))
+    return [xml_bytes[cpt_id] for cpt_id in bro_cpt_ids]
+
+
+def _get_cached_cpt_objects(bro_cpt_ids: List[str]) -> Dict[str, Optional[bytes]]:
+    """
+    Returns the CPT objects of the given BRO ids that are in the cache.
     """
-    xml_strs = asyncio.run(_async_get_xml_bytes_of_bro_cpt(bro_cpt_ids))
-    return xml_strs
+    with _CPT_OBJECTS_LOCK:
+        return {cpt_id: _CPT_OBJECTS[cpt_id] for cpt_id in bro_cpt_ids if cpt_id in _CPT_OBJECTS}
 
 
-async def _async_get_xml_bytes_of_bro_cpt(bro_cpt_ids: List[str]) -> List[str]:
+def _cache_cpt_objects(cpt_objects: Iterable[Tuple[str, Optional[bytes]]]) -> None:
     """
-    Gathers all to be performed requests.
+    Adds retrieved CPT objects to the cache, evicting the oldest entries when it is full.
+    Deregistered CPTs (None) are cached as well, so they are not requested again.
+    """
+    with _CPT_OBJECTS_LOCK:
+        for cpt_id, content in cpt_objects:
+            if content is not None and len(content) > MAX_CACHED_CPT_OBJECT_SIZE:
+                continue
+            add_to_bounded_cache(_CPT_OBJECTS, cpt_id, content, MAX_CACHED_CPT_OBJECTS)
+
+
+def _get_runner() -> asyncio.Runner:
+    """
+    Returns the shared Runner, whose event loop is reused by every call. This keeps the shared session, which is bound
+    to that event loop, and its connections alive between calls. Both are closed when the interpreter exits.
     """
-    # Catch ResourceWarnings, raised by suspected non-closure of connections.
-    # In reality they *are* closed, yet after a little while.
-    # For more information, visit: https://github.com/aio-libs/aiohttp/pull/2045
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", ResourceWarning)
-        async with aiohttp.ClientSession() as session:
-            tasks = [async_get_cpt_object_xml(session, cpt_id) for cpt_id in bro_cpt_ids]
-            xml_str_list = await asyncio.gather(*tasks, return_exceptions=False)
-        await asyncio.sleep(0.1)
-    return xml_str_list
+    global _RUNNER  # pylint: disable=global-statement
+    if _RUNNER is None:
+        _RUNNER = asyncio.Runner()
+        atexit.register(_close_runner)
+    return _RUNNER
 
 
-async def async_get_cpt_object_xml(session, bro_cpt_id: str) -> str:
+def _close_runner() -> None:
+    """
+    Closes the shared session and the event loop of the shared Runner.
+    This is skipped if a prefetch is still running in the background, since its Runner can not be closed meanwhile.
+    """
+    global _RUNNER  # pylint: disable=global-statement
+    if not _RUNNER_LOCK.acquire(timeout=RUNNER_CLOSE_TIMEOUT):  # pylint: disable=consider-using-with
+        return
+    try:
+        if _RUNNER is not None:
+            _RUNNER.run(_close_session())
+            _RUNNER.close()
+            _RUNNER = None
+    finally:
+        _RUNNER_LOCK.release()
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared session, so that connections to the BRO are kept alive and reused by subsequent requests.
+    A new session is created if there is none yet, or if the existing one is bound to another event loop.
+    """
+    global _SESSION, _SESSION_LOOP  # pylint: disable=global-statement
+    loop = asyncio.get_running_loop()
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=64, limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=15, ttl_dns_cache=300
+        )
+        # Requests run while the Runner lock is held, so a stalled response must not block the other threads for long
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=REQUEST_TIMEOUT)
+        _SESSION = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _SESSION_LOOP = loop
+    return _SESSION
+
+
+async def _close_session() -> None:
+    """
+    Closes the shared session, and yields once to the event loop so the closed transports are cleaned up right away.
+    This prevents the ResourceWarnings on connections that are only closed after the event loop is gone.
+    """
+    global _SESSION, _SESSION_LOOP  # pylint: disable=global-statement
+    if _SESSION is not None:
+        await _SESSION.close()
+        await asyncio.sleep(0)
+    _SESSION, _SESSION_LOOP = None, None
+
+
+async def _async_get_xml_bytes_of_bro_cpt(bro_cpt_ids: List[str]) -> List[Optional[bytes]]:
+    """
+    Gathers all to be performed requests.
+    If one of the requests fails, the others are cancelled and awaited before the error is raised. Otherwise they would
+    keep running on the shared event loop during later calls.
+    """
+    session = await _get_session()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    tasks = [asyncio.create_task(async_get_cpt_object_xml(session, semaphore, cpt_id)) for cpt_id in bro_cpt_ids]
+    try:
+        xml_bytes_list = await asyncio.gather(*tasks, return_exceptions=False)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return xml_bytes_list
+
+
+async def async_get_cpt_object_xml(session, semaphore: asyncio.Semaphore, bro_cpt_id: str) -> Optional[bytes]:
     """
     Performs the actual request, only adding registered CPTs.
+    The semaphore limits the amount of requests that are in flight at the same time.
+    A pooled connection may have been closed by the BRO while it was idle, which only shows when it is reused. The
+    request is therefore retried once on a new connection if the connection turns out to be closed.
     """
     headers_cpt = {
         "accept": "application/xml",
     }
     url = f"{CPT_OBJECT_URL}{bro_cpt_id}"
 
-    async with session.get(url, headers=headers_cpt) as response:  # Set up the asynchronous request
-        response.raise_for_status()
-        content = await response.text()  # Wait for the response to arrive
-        # Only retrieve registered CPT Objects.
-        if "deregistrationTime" not in content:
-            return content
+    async with semaphore:
+        for attempt in range(2):
+            try:
+                async with session.get(url, headers=headers_cpt) as response:  # Set up the asynchronous request
+                    response.raise_for_status()
+                    content = await response.read()  # Wait for the response to arrive
+                break
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError):
+                if attempt:
+                    raise
+    # Only retrieve registered CPT Objects.
+    if b"deregistrationTime" not in content:
+        return content
+    return None
@@ -0,0 +1,49 @@
+"""import asyncio
+import atexit
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import aiohttp
+import numpy as np
+import shapely
+from bro import CPTCharacteristics
+from shapely.geometry.polygon import Polygon as SPPolygon
+
+CPT_OBJECT_URL = "https://publiek.broservices.nl/sr/cpt/v1/objects/"
+MAX_CONCURRENT_REQUESTS = 16  # per host, both for the connection pool and the number of requests in flight
+MAX_CACHED_CPT_OBJECTS = 512
+MAX_CACHED_CPT_OBJECT_SIZE = 1_000_000  # bytes, larger CPT objects are always retrieved again
+RUNNER_CLOSE_TIMEOUT = 5  # seconds
+REQUEST_TIMEOUT = 10  # seconds, per request, the same limit as the requests to the BRO made by the bro package
+
+# Retrieved CPT objects, keyed by BRO id. A CPT object does not change once it is registered
+_CPT_OBJECTS: Dict[str, Optional[bytes]] = {}
+_CPT_OBJECTS_LOCK = threading.Lock()  # Only held to look up or store CPT objects, never during a request
+
+_RUNNER: Optional[asyncio.Runner] = None
+_RUNNER_LOCK = threading.Lock()  # CPT objects can be retrieved from several threads, but a Runner is not thread-safe
+_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def filter_available_cpts(params, cpts: List[CPTCharacteristics]) -> Dict[str, list]:
+    """
+from typing import Dict
+from typing import Hashable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+def add_to_bounded_cache(cache: Dict[Hashable, T], key: Hashable, value: T, max_size: int) -> None:
+    """
+    Adds a value to a cache dict that holds at most max_size entries.
+    When it is full, the oldest entry is evicted first. The caller is responsible for locking the cache if needed.
+    """
+    if key not in cache and len(cache) >= max_size:
+        del cache[next(iter(cache))]  # Evict the oldest entry
+    cache[key] = value
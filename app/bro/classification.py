@@ -14,14 +14,22 @@ SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
 CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
 from copy import deepcopy
+from functools import cached_property
+from io import BytesIO
+from io import StringIO
 from math import ceil
+from math import isnan
 from pathlib import Path
 from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Union
 
-from lxml import etree
+import numpy as np
 from munch import munchify
 from munch import unmunchify
 
@@ -32,9 +40,14 @@ from viktor.geo import GEFData as SDKGEFData
 from viktor.geo import GEFParsingException
 from viktor.geo import RobertsonMethod
 from viktor.geo import Soil
+from viktor.geo import SoilLayer
 from viktor.geo import SoilLayout
 
+from .caching import add_to_bounded_cache
+
 DEFAULT_MIN_LAYER_THICKNESS = 200
+MAX_CACHED_CLASSIFICATIONS = 32
+MISSING_VALUE = -999999
 GEF_XML_MAPPING = {
     "Rf": "frictionRatio",
     "fs": "localFriction",
@@ -44,9 +57,62 @@ GEF_XML_MAPPING = {
     "penetration_length": "penetrationLength",
 }
 
+# Locations of all elements that are read from an IMBRO xml file, relative to its root element
+IMBRO_XML_FIELDS = {
+    f"dispatchDocument/CPT_O/{field}"
+    for field in (
+        "broId",
+        "researchReportDate/date",
+        "deliveredLocation/location/pos",
+        "deliveredVerticalPosition/offset",
+        "deliveredVerticalPosition/verticalDatum",
+        "deliveredVerticalPosition/localVerticalReferencePoint",
+        "conePenetrometerSurvey/trajectory/predrilledDepth",
+        "conePenetrometerSurvey/trajectory/finalDepth",
+        "conePenetrometerSurvey/conePenetrometer/conePenetrometerType",
+        "conePenetrometerSurvey/conePenetrometer/coneSurfaceArea",
+        "conePenetrometerSurvey/conePenetrometer/frictionSleeveSurfaceArea",
+        "conePenetrometerSurvey/conePenetrometer/coneSurfaceQuotient",
+        "conePenetrometerSurvey/conePenetrometer/frictionSleeveSurfaceQuotient",
+        "conePenetrometerSurvey/conePenetrometer/coneToFrictionSleeveDistance",
+        "conePenetrometerSurvey/conePenetrationTest/cptResult/encoding/TextEncoding/tokenSeparator",
+        "conePenetrometerSurvey/conePenetrationTest/cptResult/encoding/TextEncoding/blockSeparator",
+        "conePenetrometerSurvey/conePenetrationTest/cptResult/values",
+    )
+}
+IMBRO_XML_PARAMETERS = "dispatchDocument/CPT_O/conePenetrometerSurvey/parameters"
+IMBRO_XML_CONTAINERS = {
+    location.rsplit("/", i)[0]
+    for location in (*IMBRO_XML_FIELDS, IMBRO_XML_PARAMETERS)
+    for i in range(1, location.count("/") + 1)
+}
+
+
+def _column_to_list(column: np.ndarray, cast=float) -> list:
+    """Converts a column of measurement data to a list, in which missing values (NaN) are replaced by None"""
+    return [None if isnan(value) else cast(value) for value in column.tolist()]
+
+
+def _get(data: dict, *keys: str, default=None):
+    """Returns the value that is found by following the keys through the nested dictionaries, or the default if the
+    path does not exist"""
+    for key in keys:
+        if not isinstance(data, dict) or key not in data:
+            return default
+        data = data[key]
+    return data
+
+
+def _get_float(data: dict, key: str) -> Optional[float]:
+    """Returns the value of the key as float, or None if it is not present"""
+    value = data.get(key)
+    return float(value) if value is not None else None
+
 
 def convert_xml_dict_to_cpt_dict(xml_dict) -> dict:
-    xml_data = munchify(xml_dict).dispatchDocument.CPT_O
+    xml_data = _get(xml_dict, "dispatchDocument", "CPT_O")
+    vertical_position = _get(xml_data, "deliveredVerticalPosition", default={})
+    cone_penetrometer = _get(xml_data, "conePenetrometerSurvey", "conePenetrometer", default={})
     measurement_data = {
         "Rf": [],
         "fs": [],
@@ -54,9 +120,10 @@ def convert_xml_dict_to_cpt_dict(xml_dict) -> dict:
         "elevation": [],
         "corrected_depth": [],
     }
-    elevation_offset = int(float(xml_data.deliveredVerticalPosition.offset) * 1000)
+    ground_level = float(vertical_position["offset"])
+    elevation_offset = int(ground_level * 1000)
     mapping = {}
-    for i, (tag, value) in enumerate(xml_data.conePenetrometerSurvey.parameters):
+    for i, (tag, value) in enumerate(_get(xml_data, "conePenetrometerSurvey", "parameters", default=[])):
         for key, label in GEF_XML_MAPPING.items():
             if tag == label and value is True:
                 try:
@@ -65,17 +132,18 @@ def convert_xml_dict_to_cpt_dict(xml_dict) -> dict:
                     raise UserError(f'Missing "{key}" in XML data') from e
     penetration_length_index = mapping.pop("penetration_length", None)
 
+    cpt_result = _get(xml_data, "conePenetrometerSurvey", "conePenetrationTest", "cptResult")
     token_separator = ","
     block_separator = ";"
-    if xml_data.conePenetrometerSurvey.conePenetrationTest.cptResult.encoding.TextEncoding:
-        x_ = xml_data
-        token_separator = x_.conePenetrometerSurvey.conePenetrationTest.cptResult.encoding.TextEncoding.tokenSeparator
-        block_separator = x_.conePenetrometerSurvey.conePenetrationTest.cptResult.encoding.TextEncoding.blockSeparator
-
-    data_rows = [
-        row.split(token_separator)
-        for row in xml_data.conePenetrometerSurvey.conePenetrationTest.cptResult["values"].split(block_separator)[:-1]
-    ]
+    text_encoding = _get(cpt_result, "encoding", "TextEncoding")
+    if text_encoding:
+        token_separator = text_encoding.get("tokenSeparator", token_separator)
+        block_separator = text_encoding.get("blockSeparator", block_separator)
+
+    rows = (cpt_result["values"] or "").replace(block_separator, "\n")
+    if not rows.strip():
+        raise UserError("Missing measurement values in XML data")
+    data = np.loadtxt(StringIO(rows), delimiter=token_separator, ndmin=2)
 
     # For some reason, in some xml files the rows are scrambled, so we need to sort them by penetration length
     warning_msg = None
@@ -87,27 +155,23 @@ def convert_xml_dict_to_cpt_dict(xml_dict) -> dict:
             mapping["corrected_depth"] = penetration_length_index
             warning_msg = "Penetration length used as elevation as data was missing"
 
-        sorted_data = sorted(data_rows, key=lambda x: float(x[mapping["elevation"]]))
+        sorted_data = data[np.argsort(data[:, mapping["elevation"]], kind="stable")]
 
     except KeyError as e:
         # TODO: Add non-breaking user messages in V14
         raise UserError(f"Missing {e} in XML data") from e
 
-    for data in sorted_data:
-        for key, col_index in mapping.items():
-            data_value = float(data[col_index])
-            if data_value == float(-999999):
-                measurement_data[key].append(None)
-            else:
-                if key == "elevation":
-                    data_point = elevation_offset - int(data_value * 1000)
-                elif key == "corrected_depth":
-                    data_point = int(data_value * 1e3)
-                elif key == "Rf":
-                    data_point = data_value / 100
-                else:
-                    data_point = data_value
-                measurement_data[key].append(data_point)
+    sorted_data[sorted_data == MISSING_VALUE] = np.nan
+    for key, col_index in mapping.items():
+        column = sorted_data[:, col_index]
+        if key == "elevation":
+            measurement_data[key] = _column_to_list(elevation_offset - np.trunc(column * 1000), cast=int)
+        elif key == "corrected_depth":
+            measurement_data[key] = _column_to_list(np.trunc(column * 1e3), cast=int)
+        elif key == "Rf":
+            measurement_data[key] = _column_to_list(column / 100)
+        else:
+            measurement_data[key] = _column_to_list(column)
 
     if not measurement_data["Rf"]:  # If Rf is not provided in xml file, then calculate it
         measurement_data["Rf"] = [
@@ -115,53 +179,23 @@ def convert_xml_dict_to_cpt_dict(xml_dict) -> dict:
             for qc, fs in zip(measurement_data["qc"], measurement_data["fs"])
         ]
 
-    coneSurfaceQuotient = (
-        float(xml_data.conePenetrometerSurvey.conePenetrometer.coneSurfaceQuotient)
-        if "coneSurfaceQuotient" in xml_data.keys()
-        else None
-    )
-
-    frictionSleeveSurfaceQuotient = (
-        float(xml_data.conePenetrometerSurvey.conePenetrometer.coneSurfaceQuotient)
-        if "frictionSleeveSurfaceQuotient" in xml_data.keys()
-        else None
-    )
-
-    coneToFrictionSleeveDistance = (
-        float(xml_data.conePenetrometerSurvey.conePenetrometer.coneToFrictionSleeveDistance)
-        if "coneToFrictionSleeveDistance" in xml_data.keys()
-        else None
-    )
-
-    coneSurfaceArea = (
-        float(xml_data.conePenetrometerSurvey.conePenetrometer.coneSurfaceArea)
-        if "coneSurfaceArea" in xml_data.keys()
-        else None
-    )
-
-    frictionSleeveSurfaceArea = (
-        float(xml_data.conePenetrometerSurvey.conePenetrometer.frictionSleeveSurfaceArea)
-        if "frictionSleeveSurfaceArea" in xml_data.keys()
-        else None
-    )
-
     return {
         "headers": {
-            "name": xml_data.broId,
-            "gef_file_date": xml_data.researchReportDate.get("date"),
-            "height_system": xml_data.deliveredVerticalPosition.verticalDatum,
-            "fixed_horizontal_level": xml_data.deliveredVerticalPosition.localVerticalReferencePoint,
-            "cone_type": xml_data.conePenetrometerSurvey.conePenetrometer.conePenetrometerType,
-            "cone_tip_area": coneSurfaceArea,
-            "friction_sleeve_area": frictionSleeveSurfaceArea,
-            "surface_area_quotient_tip": coneSurfaceQuotient,
-            "surface_area_quotient_friction_sleeve": frictionSleeveSurfaceQuotient,
-            "distance_cone_to_centre_friction_sleeve": coneToFrictionSleeveDistance,
-            "excavation_depth": xml_data.conePenetrometerSurvey.trajectory.predrilledDepth,
-            "corrected_depth": float(xml_data.conePenetrometerSurvey.trajectory.finalDepth) * 1000,
-            "x_y_coordinates": list(map(float, xml_data.deliveredLocation.location.pos.split(" "))),
-            "ground_level_wrt_reference_m": float(xml_data.deliveredVerticalPosition.offset),
-            "ground_level_wrt_reference": float(xml_data.deliveredVerticalPosition.offset) * 1000,
+            "name": _get(xml_data, "broId"),
+            "gef_file_date": _get(xml_data, "researchReportDate", "date"),
+            "height_system": vertical_position.get("verticalDatum"),
+            "fixed_horizontal_level": vertical_position.get("localVerticalReferencePoint"),
+            "cone_type": cone_penetrometer.get("conePenetrometerType"),
+            "cone_tip_area": _get_float(cone_penetrometer, "coneSurfaceArea"),
+            "friction_sleeve_area": _get_float(cone_penetrometer, "frictionSleeveSurfaceArea"),
+            "surface_area_quotient_tip": _get_float(cone_penetrometer, "coneSurfaceQuotient"),
+            "surface_area_quotient_friction_sleeve": _get_float(cone_penetrometer, "frictionSleeveSurfaceQuotient"),
+            "distance_cone_to_centre_friction_sleeve": _get_float(cone_penetrometer, "coneToFrictionSleeveDistance"),
+            "excavation_depth": _get(xml_data, "conePenetrometerSurvey", "trajectory", "predrilledDepth"),
+            "corrected_depth": float(_get(xml_data, "conePenetrometerSurvey", "trajectory", "finalDepth")) * 1000,
+            "x_y_coordinates": list(map(float, _get(xml_data, "deliveredLocation", "location", "pos").split(" "))),
+            "ground_level_wrt_reference_m": ground_level,
+            "ground_level_wrt_reference": ground_level * 1000,
         },
         "measurement_data": measurement_data,
         "warning_msg": warning_msg,
@@ -189,31 +223,44 @@ class IMBROFile:
         return_gef_data_obj: bool = False,
     ) -> Union[dict, CPTData]:
         """Parses the xml file and returns either a cpt dictionary or a CPTData object"""
-        xml_dict = self._parse_xml_file(self.file_content)
+        xml_dict = self._stream_cpt_fields(self.file_content)
         cpt_dict = convert_xml_dict_to_cpt_dict(xml_dict)
         if return_gef_data_obj:
             return CPTData(cpt_dict=cpt_dict)
         return cpt_dict
 
-    def _parse_xml_file(self, file_content: bytes) -> dict:
-        return self._parse_xml_to_dict_recursively(etree.fromstring(file_content))
+    @staticmethod
+    def _stream_cpt_fields(file_content: bytes) -> dict:
+        """Streams through the xml structure and only keeps the elements that are listed in IMBRO_XML_FIELDS, therefore
+        preserving their structure and values. Elements are cleared as soon as they are processed to limit memory use."""
+        xml_dict = {}
+        stack = []  # (location, tag, node) of every open element, node being the dict or list it is parsed into
+        for event, element in ET.iterparse(BytesIO(file_content), events=("start", "end")):
+            if event == "start":
+                if not stack:  # The root element itself is not part of the data structure
+                    stack.append(("", "", xml_dict))
+                    continue
+                parent_location, _, parent = stack[-1]
+                tag = element.tag.rpartition("}")[2]  # Strip the namespace
+                location = f"{parent_location}/{tag}" if parent_location else tag
+                if location in IMBRO_XML_CONTAINERS:
+                    node = parent.setdefault(tag, {})
+                elif location == IMBRO_XML_PARAMETERS:
+                    node = parent.setdefault(tag, [])
+                else:
+                    node = None
+                stack.append((location, tag, node))
+                continue
 
-    @classmethod
-    def _parse_xml_to_dict_recursively(cls, node):
-        """Builds the data object from the xml structure passed, therefore preserving the structure and the values"""
-        if not node.getchildren():
-            return node.text
-
-        grand_children = {}
-        for child in node.getchildren():
-            tag = child.tag.split("}")[-1] if "}" in child.tag else child.tag
-            if tag == "parameters":
-                grand_children["parameters"] = [
-                    (sub_child.tag.split("}")[-1], sub_child.text in {"ja", 1}) for sub_child in child
-                ]
-            else:
-                grand_children[tag] = cls._parse_xml_to_dict_recursively(child)
-        return grand_children
+            location, tag, _ = stack.pop()
+            if stack:
+                parent = stack[-1][2]
+                if isinstance(parent, list):
+                    parent.append((tag, element.text in {"ja", 1}))
+                elif location in IMBRO_XML_FIELDS:
+                    parent[tag] = element.text
+            element.clear()
+        return xml_dict
 
 
 class CPT:
@@ -234,32 +281,33 @@ class CPT:
     @staticmethod
     def filter_nones_from_params_dict(raw_dict) -> dict:
         """Removes all rows which contain one or more None-values"""
-        rows_to_be_removed = []
-        for row_index, items in enumerate(zip(*raw_dict["measurement_data"].values())):
-            if None in items:
-                rows_to_be_removed.append(row_index)
-        for row in reversed(rows_to_be_removed):
-            for signal in raw_dict["measurement_data"].keys():
-                del raw_dict["measurement_data"][signal][row]
+        measurement_data = raw_dict["measurement_data"]
+        rows_to_keep = [
+            row_index for row_index, items in enumerate(zip(*measurement_data.values())) if None not in items
+        ]
+        for signal, values in measurement_data.items():
+            measurement_data[signal] = [values[row_index] for row_index in rows_to_keep]
         return raw_dict
 
 
 def convert_soil_layout_from_mm_to_m(soil_layout: SoilLayout) -> SoilLayout:
     """Converts the units of the SoilLayout from mm to m."""
-    serialization_dict = soil_layout.serialize()
-    for layer in serialization_dict["layers"]:
-        layer["top_of_layer"] = layer["top_of_layer"] / 1000
-        layer["bottom_of_layer"] = layer["bottom_of_layer"] / 1000
-    return SoilLayout.from_dict(serialization_dict)
+    return SoilLayout(
+        [
+            SoilLayer(layer.soil, layer.top_of_layer / 1000, layer.bottom_of_layer / 1000, properties=layer.properties)
+            for layer in soil_layout.layers
+        ]
+    )
 
 
 def convert_soil_layout_from_m_to_mm(soil_layout: SoilLayout) -> SoilLayout:
     """Converts the units of the SoilLayout from m to mm."""
-    serialization_dict = soil_layout.serialize()
-    for layer in serialization_dict["layers"]:
-        layer["top_of_layer"] = layer["top_of_layer"] * 1000
-        layer["bottom_of_layer"] = layer["bottom_of_layer"] * 1000
-    return SoilLayout.from_dict(serialization_dict)
+    return SoilLayout(
+        [
+            SoilLayer(layer.soil, layer.top_of_layer * 1000, layer.bottom_of_layer * 1000, properties=layer.properties)
+            for layer in soil_layout.layers
+        ]
+    )
 
 
 def convert_soil_layout_to_input_table_field(soil_layout: SoilLayout) -> List[dict]:
@@ -311,11 +359,15 @@ class Classification:
     It also provides the correct soil mapping needs for the visualizations of the soil layers.
     """
 
+    # Classified CPT files, shared between instances and keyed by (file digest, ground water level, method, table)
+    _classified_cpt_files: Dict[tuple, dict] = {}
+    _classified_cpt_files_lock = threading.Lock()  # CPTs may be classified from multiple threads at once
+
     def __init__(self, robertson_table: List[Dict]):
         self._method = "robertson"
         self._table = unmunchify(robertson_table)
 
-    @property
+    @cached_property
     def table(self) -> List[dict]:
         """Returns a cleaned up table that can be used for the Classification methods"""
         return _update_color_string(self._table)
@@ -323,24 +375,53 @@ class Classification:
     def method(self) -> RobertsonMethod:
         """Returns the appropriate _ClassificationMethod for the CPTData.classify() function"""
         if self._method == "robertson":
-            return RobertsonMethod(self.table)
+            return self._robertson_method
         raise UserError(f"The {self._method} method has not yet been implemented")
 
-    @property
+    @cached_property
+    def _robertson_method(self) -> RobertsonMethod:
+        """The RobertsonMethod only holds the soil properties of the table, so a single instance is reused"""
+        return RobertsonMethod(self.table)
+
+    @cached_property
     def soil_mapping(self) -> dict:
         """Returns a mapping between the soil name visible in the UI and the Soil object used in the logic"""
         soil_mapping = {}
         for soil in self.table:
             ui_name = soil["ui_name"]
-            properties = deepcopy(soil)
+            properties = dict(soil)  # The values are immutable, so a shallow copy suffices
             if self._method == "robertson":
                 del properties["color"]
             soil_mapping[ui_name] = Soil(soil["name"], convert_to_color(soil["color"]), properties=properties)
         return soil_mapping
 
-    def classify_cpt_file(self, cpt_file: IMBROFile, saved_ground_water_level=None) -> dict:
-        """Classify an uploaded CPT File based on the selected _ClassificationMethod"""
+    @cached_property
+    def _table_key(self) -> int:
+        """Returns a hash of the table, to distinguish classifications with different tables in the cache"""
+        return hash(tuple(tuple(sorted(row.items())) for row in self.table))
 
+    def classify_cpt_file(self, cpt_file: IMBROFile, saved_ground_water_level=None) -> dict:
+        """Classify an uploaded CPT File based on the selected _ClassificationMethod
+
+        The result is cached on the content of the file, so classifying the same file again is skipped.
+        """
+        cache = self._classified_cpt_files
+        cache_key = (
+            hashlib.blake2b(cpt_file.file_content, digest_size=16).digest(),
+            saved_ground_water_level,
+            self._method,
+            self._table_key,
+        )
+        with self._classified_cpt_files_lock:
+            classified_cpt = cache.get(cache_key)
+        if classified_cpt is None:
+            # Classify outside of the lock, so that different files can be classified at the same time
+            classified_cpt = self._classify_cpt_file(cpt_file, saved_ground_water_level)
+            with self._classified_cpt_files_lock:
+                add_to_bounded_cache(cache, cache_key, classified_cpt, MAX_CACHED_CLASSIFICATIONS)
+        return deepcopy(classified_cpt)
+
+    def _classify_cpt_file(self, cpt_file: IMBROFile, saved_ground_water_level=None) -> dict:
         try:
             # Parse the GEF file content
             cpt_data_object = cpt_file.parse(return_gef_data_obj=True)
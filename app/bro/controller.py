@@ -14,26 +14,31 @@ SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
 CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
 
 # pylint: disable=line-too-long, c-extension-no-member
 from math import floor
+from operator import attrgetter
 from pathlib import Path
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
+from zipfile import ZIP_DEFLATED
+from zipfile import ZipFile
 
-import geopandas as gpd
+import numpy as np
 from bro import Envelope
 from bro import Point
 from bro import get_cpt_characteristics
-from bro import get_cpt_object
-from plotly import graph_objects as go
-from plotly.subplots import make_subplots
 from requests import ReadTimeout
 
 from viktor import Color
-from viktor import File
 from viktor import UserError
 from viktor import ViktorController
 from viktor.core import progress_message
@@ -60,8 +65,19 @@ from .classification import Classification
 from .classification import IMBROFile
 from .parametrization import DEFAULT_ROBERTSON_TABLE
 from .parametrization import Parametrization
+from .parametrization import dump_retrieved_cpts
+from .parametrization import get_polygon_hash
+from .parametrization import parse_retrieved_cpts
 
 MAX_AMOUNT_OF_CPTS = 15
+MAX_CLASSIFICATION_WORKERS = 4
+MAX_CACHED_COMPARISONS = 8  # a figure of 10 deep CPTs can take a few MB
+
+# Fetches all attributes of a soil layer that are plotted at once
+get_soil_layer_attributes = attrgetter("soil.properties.ui_name", "soil.color.rgb", "top_of_layer", "bottom_of_layer")
+
+# The default table never changes, so its classifier (including its soil mapping) is shared by every view
+DEFAULT_CLASSIFICATION = Classification(DEFAULT_ROBERTSON_TABLE)
 
 
 class Controller(ViktorController):
@@ -87,32 +103,21 @@ class Controller(ViktorController):
 
         interaction_cpts = []
         if params.retrieved_cpts:
-            filtered_cpts = json.loads(params["retrieved_cpts"])["cpt_ids"]
-            for cpt in filtered_cpts:
-                color = (
-                    Color.viktor_yellow()
-                    if cpt["bro_id"] in params.step_2.signals_selected_cpts
-                    else Color.viktor_blue()
-                )
-                point = MapPoint(
-                    float(cpt["lat"]),
-                    float(cpt["lon"]),
-                    title=cpt["bro_id"],
-                    description=f"CPT performed at: {cpt['date']}  \n",
-                    color=color,
-                    identifier=cpt["bro_id"],
-                    icon="triangle-down-filled",
-                )
-                if params.step_1.show_labels:
-                    label = MapLabel(
-                        float(cpt["lat"]),
-                        float(cpt["lon"]),
-                        text=cpt["bro_id"],
-                        scale=20.5 - params.step_1.label_size * 0.5,
-                    )
-                    labels.append(label)
-                features.append(point)
-                interaction_cpts.append(point)
+            available_points = get_cpt_map_points(params.retrieved_cpts, Color.viktor_blue())
+            # Swap in the highlighted points of the selected CPTs, instead of recreating all points
+            selected_cpt_ids = frozenset(params.step_2.signals_selected_cpts or ())
+            if selected_cpt_ids:
+                selected_points = get_cpt_map_points(params.retrieved_cpts, Color.viktor_yellow())
+                interaction_cpts = [
+                    selected_points[bro_id] if bro_id in selected_cpt_ids else point
+                    for bro_id, point in available_points.items()
+                ]
+            else:
+                interaction_cpts = list(available_points.values())
+            features += interaction_cpts
+
+            if params.step_1.show_labels:
+                labels += get_cpt_map_labels(params.retrieved_cpts, params.step_1.label_size)
 
         interaction_groups = {
             "points": interaction_cpts,
@@ -144,16 +149,8 @@ class Controller(ViktorController):
         if len(cpt_ids) > 10:
             raise UserError("Please select no more than 10 CPTs to compare.")
 
-        soil_mapping = Classification(DEFAULT_ROBERTSON_TABLE).soil_mapping
-        progress_message("Gathering CPTs to add to comparison")
-
-        xml_files = [get_cpt_object(bro_cpt_id) for bro_cpt_id in cpt_ids]
-        cpt_dicts = [IMBROFile(xml_file_content) for xml_file_content in xml_files]
-        # Classify
-        classified_cpts = [Classification(DEFAULT_ROBERTSON_TABLE).classify_cpt_file(cpt) for cpt in cpt_dicts]
-        cpts = [CPT(cpt_params=classified_cpt, soil_mapping=soil_mapping) for classified_cpt in classified_cpts]
-
-        figure = visualize_cpts_with_classifications(cpts)
+        # The figure is cached on the selection in order, since that order determines the order of the subplots
+        figure = get_cpt_comparison_figure(tuple(cpt_ids))
         return PlotlyResult(figure)
 
     @WebView(" ", duration_guess=1)
@@ -170,34 +167,15 @@ class Controller(ViktorController):
         Downloads the selected CPTs in XML format.
         """
         cpt_ids = params.step_2.signals_selected_cpts
-        xml_bytes = []
-        for chunk in splitter(
-            cpt_ids, MAX_AMOUNT_OF_CPTS
-        ):  # to prevent overflowing of client, split async requests up in smaller parts
-            xml_bytes += [xml_str.encode("utf-8") for xml_str in get_cpt_object_xml_async(chunk)]
-
-        zipped_files = {}
-        for cpt_id, xml in zip(cpt_ids, xml_bytes):
-            zipped_files[f"{cpt_id}.xml"] = File.from_data(xml)
-        return DownloadResult(zipped_files=zipped_files, file_name="CPTs_in_bounding_box.zip")
+        return DownloadResult(zip_cpt_objects(cpt_ids), file_name="CPTs_in_bounding_box.zip")
 
     @staticmethod
     def download_all_cpts_from_bro(params, **kwargs) -> DownloadResult:
         """
         Downloads the all available CPTs in the selected area in XML format.
         """
-        cpt_ids = [cpt["bro_id"] for cpt in json.loads(params["retrieved_cpts"])["cpt_ids"]]
-
-        xml_bytes = []
-        for chunk in splitter(
-            cpt_ids, MAX_AMOUNT_OF_CPTS
-        ):  # to prevent overflowing of client, split async requests up in smaller parts
-            xml_bytes += [xml_str.encode("utf-8") for xml_str in get_cpt_object_xml_async(chunk)]
-
-        zipped_files = {}
-        for cpt_id, xml in zip(cpt_ids, xml_bytes):
-            zipped_files[f"{cpt_id}.xml"] = File.from_data(xml)
-        return DownloadResult(zipped_files=zipped_files, file_name="CPTs_in_bounding_box.zip")
+        cpt_ids = parse_retrieved_cpts(params.retrieved_cpts)["bro_ids"]
+        return DownloadResult(zip_cpt_objects(cpt_ids), file_name="CPTs_in_bounding_box.zip")
 
     @staticmethod
     def select_from_map(event: Optional[InteractionEvent], **kwargs) -> SetParamsResult:
@@ -209,6 +187,8 @@ class Controller(ViktorController):
             cpt_ids = event.value
             if not cpt_ids:
                 raise UserError("Please select CPTs for comparison")
+            # Already retrieve the selected CPTs, while the user moves on to the comparison or the download
+            threading.Thread(target=prefetch_cpt_objects, args=(cpt_ids,), daemon=True).start()
             updated_params = {"step_2": {"signals_selected_cpts": cpt_ids}}
         return SetParamsResult(updated_params)
 
@@ -224,6 +204,10 @@ class Controller(ViktorController):
         begin_date = datetime(2015, 1, 1).strftime("%Y-%m-%d")
         end_date = datetime.today().strftime("%Y-%m-%d")
 
+        # Compute the boundary of NL in the background while waiting on the BRO, so the map that shows the retrieved CPTs
+        # finds it cached. If it is already cached, the thread returns right away
+        threading.Thread(target=self.get_nl_boundary_map_features, daemon=True).start()
+
         # TODO: Add logging for get_cpt_characteristics in V14
         try:
             cpt_characteristics = get_cpt_characteristics(begin_date, end_date, envelope)
@@ -232,32 +216,34 @@ class Controller(ViktorController):
         except ReadTimeout as e:
             raise UserError(f"{e}")
 
-        filtered_cpt_data = filter_available_cpts(params, cpt_characteristics)
-
-        filtered_cpts = {
-            "cpt_ids": filtered_cpt_data,
-            "selected_polygon_points": [(p.lat, p.lon) for p in params.step_1.geo_polygon.points],
-        }
+        filtered_cpts = filter_available_cpts(params, cpt_characteristics)
+        filtered_cpts["polygon_hash"] = get_polygon_hash(params.step_1.geo_polygon)
 
-        if not filtered_cpts["cpt_ids"]:
+        if not filtered_cpts["bro_ids"]:
             raise UserError("No CPTs are available in the selected area. Please draw a larger polygon.")
-        return SetParamsResult(params={"retrieved_cpts": json.dumps(filtered_cpts)})
+        return SetParamsResult(params={"retrieved_cpts": dump_retrieved_cpts(filtered_cpts)})
 
     @staticmethod
     def get_envelope_from_polygon(geo_polygon: GeoPolygon) -> Envelope:
         """
         Creates an Envelope that can be used in the bro package.
         """
-        latitudes, longitudes = map(list, zip(*[(p.lat, p.lon) for p in geo_polygon.points]))
-        lower_corner = Point(min(latitudes), min(longitudes))
-        upper_corner = Point(max(latitudes), max(longitudes))
+        points = geo_polygon.points
+        coordinates = np.fromiter(((p.lat, p.lon) for p in points), dtype=np.dtype((np.float64, 2)), count=len(points))
+        lower_corner = Point(*coordinates.min(axis=0).tolist())
+        upper_corner = Point(*coordinates.max(axis=0).tolist())
         return Envelope(lower_corner, upper_corner)
 
     @staticmethod
+    @lru_cache(maxsize=1)
     def get_nl_boundary_map_features() -> MapPolyline:
         """
         Gets the boundary of NL from a shapefile containing the provinces of NL.
+        The boundary never changes, so it is only computed once and reused by every render of the map.
         """
+        # geopandas is only imported when needed, since importing it takes long
+        import geopandas as gpd  # pylint: disable=import-outside-toplevel
+
         # Read file with provinces information
         with open(Path(__file__).parent / "nl_provinces.json", "r", encoding="utf-8") as f:
             df = gpd.read_file(f).to_crs("WGS84")
@@ -270,6 +256,101 @@ class Controller(ViktorController):
         return MapPolyline(*points)
 
 
+@lru_cache(maxsize=MAX_CACHED_COMPARISONS)
+def get_cpt_comparison_figure(cpt_ids: Tuple[str, ...]) -> str:
+    """
+    Retrieves and classifies the CPTs, and creates the comparison figure of them.
+    The result only depends on the CPTs, so showing the same comparison again reuses the figure.
+    """
+    soil_mapping = DEFAULT_CLASSIFICATION.soil_mapping
+    progress_message("Gathering CPTs to add to comparison")
+
+    xml_files = []
+    for chunk in splitter(cpt_ids, MAX_AMOUNT_OF_CPTS):
+        xml_files += get_cpt_object_xml_async(chunk)
+    # Deregistered CPTs are not retrieved and therefore left out of the comparison
+    deregistered_cpt_ids = [cpt_id for cpt_id, xml_file_content in zip(cpt_ids, xml_files) if xml_file_content is None]
+    xml_files = [xml_file_content for xml_file_content in xml_files if xml_file_content is not None]
+    if not xml_files:
+        raise UserError(
+            f"The selected CPTs have been deregistered from the BRO and can not be compared: "
+            f"{', '.join(deregistered_cpt_ids)}"
+        )
+
+    def parse_and_classify(xml_file_content: bytes) -> CPT:
+        classified_cpt = DEFAULT_CLASSIFICATION.classify_cpt_file(IMBROFile(xml_file_content))
+        return CPT(cpt_params=classified_cpt, soil_mapping=soil_mapping)
+
+    # Every CPT is classified independently, which mostly consists of waiting on the classification by the platform
+    with ThreadPoolExecutor(max_workers=min(MAX_CLASSIFICATION_WORKERS, len(xml_files))) as executor:
+        cpts = list(executor.map(parse_and_classify, xml_files))
+
+    return visualize_cpts_with_classifications(cpts, deregistered_cpt_ids=deregistered_cpt_ids)
+
+
+@lru_cache(maxsize=8)
+def get_cpt_map_points(retrieved_cpts: str, color: Color) -> Dict[str, MapPoint]:
+    """
+    Creates the map points of the retrieved CPTs in the given color, keyed by BRO id.
+    The points only depend on the retrieved CPTs, so they are reused by subsequent renders of the map.
+    """
+    cpts = parse_retrieved_cpts(retrieved_cpts)
+    return {
+        bro_id: MapPoint(
+            lat,
+            lon,
+            title=bro_id,
+            description=f"CPT performed at: {date}  \n",
+            color=color,
+            identifier=bro_id,
+            icon="triangle-down-filled",
+        )
+        for bro_id, lat, lon, date in zip(cpts["bro_ids"], cpts["lats"], cpts["lons"], cpts["dates"])
+    }
+
+
+@lru_cache(maxsize=8)
+def get_cpt_map_labels(retrieved_cpts: str, label_size: float) -> List[MapLabel]:
+    """
+    Creates the map labels of the retrieved CPTs, which are reused by subsequent renders of the map.
+    """
+    cpts = parse_retrieved_cpts(retrieved_cpts)
+    scale = 20.5 - label_size * 0.5
+    return [
+        MapLabel(lat, lon, text=bro_id, scale=scale)
+        for bro_id, lat, lon in zip(cpts["bro_ids"], cpts["lats"], cpts["lons"])
+    ]
+
+
+def zip_cpt_objects(cpt_ids: List[str]) -> bytes:
+    """
+    Retrieves the CPT objects and bundles them as XML files in a zip file.
+    The CPT objects are retrieved and written per chunk, so only one chunk of XML is held in memory next to the zip,
+    and other retrievals in the meantime only have to wait for the current chunk.
+    """
+    zip_buffer = BytesIO()
+    # XML compresses well, so the files are deflated to reduce the size of the download
+    with ZipFile(zip_buffer, "w", compression=ZIP_DEFLATED, compresslevel=6) as zip_file:
+        for chunk in splitter(
+            cpt_ids, MAX_AMOUNT_OF_CPTS
+        ):  # to prevent overflowing of client, split async requests up in smaller parts
+            for cpt_id, xml in zip(chunk, get_cpt_object_xml_async(chunk)):
+                if xml is not None:  # Deregistered CPTs are not retrieved
+                    zip_file.writestr(f"{cpt_id}.xml", xml)
+    return zip_buffer.getvalue()
+
+
+def prefetch_cpt_objects(cpt_ids: List[str]) -> None:
+    """
+    Retrieves the CPT objects in the background, so they are cached by the time they are needed.
+    """
+    try:
+        for chunk in splitter(cpt_ids, MAX_AMOUNT_OF_CPTS):
+            get_cpt_object_xml_async(chunk)
+    except Exception:  # pylint: disable=broad-except
+        pass  # The CPT objects are simply retrieved again when they are needed, which reports the error instead
+
+
 def splitter(l: list, chunk_size: int):
     """
     Spliets a list in chunks, with set chunk size.
@@ -280,8 +361,13 @@ def splitter(l: list, chunk_size: int):
 
 def visualize_cpts_with_classifications(
     all_cpt_models: List["CPT"],
+    deregistered_cpt_ids: Optional[List[str]] = None,
 ) -> str:
     """Creates an interactive plot using plotly, showing the Robertson classification per CPT together with Qc / Rf values."""
+    # plotly is only imported when needed, since importing it takes long
+    from plotly import graph_objects as go  # pylint: disable=import-outside-toplevel
+    from plotly.subplots import make_subplots  # pylint: disable=import-outside-toplevel
+
     cols = len(all_cpt_models)
     fig = make_subplots(
         rows=1,
@@ -303,12 +389,15 @@ def visualize_cpts_with_classifications(
         if cpt.warning_msg:
             cpts_using_penetration_length.append(cpt.name)
 
+        # Missing values (None) become NaN, which plotly leaves out of the line just like None
+        elevation = np.array(cpt.parsed_cpt.elevation, dtype=np.float64) * 1e-3
+
         # Add Qc plot
         fig.add_trace(
             go.Scatter(
                 name="Cone Resistance",
                 x=cpt.parsed_cpt.qc,
-                y=[el * 1e-3 for el in cpt.parsed_cpt.elevation],
+                y=elevation,
                 mode="lines",
                 line=dict(color="mediumblue", width=1),
                 legendgroup="Cone Resistance",
@@ -318,24 +407,12 @@ def visualize_cpts_with_classifications(
             col=col,
         )
 
-        fig.update_xaxes(
-            row=1,
-            col=col,
-            **standard_line_options,
-            **standard_grid_options,
-            range=[0, 40],
-            tick0=0,
-            dtick=5,
-            title_text="qc [MPa] / Rf [%]",
-            title_font=dict(color="black", size=10),
-        )
-
         # Add Rf plot
         fig.add_trace(
             go.Scatter(
                 name="Friction ratio",
-                x=[rfval * 100 if rfval else rfval for rfval in cpt.parsed_cpt.Rf],
-                y=[el * 1e-3 if el else el for el in cpt.parsed_cpt.elevation],
+                x=np.array(cpt.parsed_cpt.Rf, dtype=np.float64) * 100,
+                y=elevation,
                 mode="lines",
                 visible=True,
                 line=dict(color="red", width=1),
@@ -346,51 +423,63 @@ def visualize_cpts_with_classifications(
             col=col,
         )
 
-        fig.update_yaxes(
-            row=1,
-            col=col,
-            **standard_grid_options,
-            title_text="Depth [m] w.r.t. NAP" if col == 1 else "",
-            tick0=floor(all_cpt_models[0].parsed_cpt.elevation[-1] / 1e3) - 5,
-            dtick=2,
-        )
-
         # If no attribute is available
         if not hasattr(cpt, "soil_layout_original"):
             continue
 
         # Add bars for each soil type separately in order to be able to set legend labels
-        unique_soil_types_in_cpt = {layer.soil.properties.ui_name for layer in [*cpt.soil_layout_original.layers]}
-
-        for ui_name in unique_soil_types_in_cpt:
-            soil_type_layers = [
-                layer for layer in cpt.soil_layout_original.layers if layer.soil.properties.ui_name == ui_name
-            ]
+        soil_type_layers_in_cpt = defaultdict(list)
+        for ui_name, *layer_attributes in map(get_soil_layer_attributes, cpt.soil_layout_original.layers):
+            soil_type_layers_in_cpt[ui_name].append(layer_attributes)
+
+        for ui_name, soil_type_layers in soil_type_layers_in_cpt.items():
+            thicknesses, colors, hovertexts, bases = [], [], [], []
+            for rgb, top_of_layer, bottom_of_layer in soil_type_layers:
+                thicknesses.append(-(top_of_layer - bottom_of_layer) * 1e-3)
+                colors.append(f"rgb{rgb}")
+                hovertexts.append(
+                    f"Soil Type: {ui_name}<br>"
+                    f"Top of layer: {top_of_layer * 1e-3:.2f}<br>"
+                    f"Bottom of layer: {bottom_of_layer * 1e-3:.2f}"
+                )
+                bases.append(top_of_layer * 1e-3)
 
             fig.add_trace(
                 go.Bar(
                     name=ui_name,
                     x=[20] * len(soil_type_layers),
-                    y=[-layer.thickness * 1e-3 for layer in soil_type_layers],
+                    y=thicknesses,
                     width=40,
-                    marker_color=[f"rgb{layer.soil.color.rgb}" for layer in soil_type_layers],
-                    hovertext=[
-                        f"Soil Type: {layer.soil.properties.ui_name}<br>"
-                        f"Top of layer: {layer.top_of_layer * 1e-3:.2f}<br>"
-                        f"Bottom of layer: {layer.bottom_of_layer * 1e-3:.2f}"
-                        for layer in soil_type_layers
-                    ],
+                    marker_color=colors,
+                    hovertext=hovertexts,
                     hoverinfo="text",
                     opacity=0.5,
                     legendgroup=ui_name,
                     showlegend=bool(ui_name not in unique_soil_names),
-                    base=[layer.top_of_layer * 1e-3 for layer in soil_type_layers],
+                    base=bases,
                 ),
                 row=1,
                 col=col,
             )
 
-        unique_soil_names.update(unique_soil_types_in_cpt)
+        unique_soil_names.update(soil_type_layers_in_cpt)
+
+    # The axes of all subplots are formatted the same, so they are updated at once
+    fig.update_xaxes(
+        **standard_line_options,
+        **standard_grid_options,
+        range=[0, 40],
+        tick0=0,
+        dtick=5,
+        title_text="qc [MPa] / Rf [%]",
+        title_font=dict(color="black", size=10),
+    )
+    fig.update_yaxes(
+        **standard_grid_options,
+        title_text="",
+        tick0=floor(all_cpt_models[0].parsed_cpt.elevation[-1] / 1e3) - 5,
+        dtick=2,
+    )
 
     # fig.add_hline(y=self.parsed_cpt.elevation[0] * 1e-3, line=dict(color='Black', width=1),
     #               row='all', col='all') # TODO Horizontal line for groundlevel: a bit ugly
@@ -411,6 +500,19 @@ def visualize_cpts_with_classifications(
             borderwidth=1,
             bordercolor="black",
         )
+    if deregistered_cpt_ids:
+        fig.add_annotation(
+            x=0.5,
+            y=1.24 if cpts_using_penetration_length else 1.12,
+            xref="paper",
+            yref="paper",
+            text=f"<b>The following CPTs are left out because they have been deregistered from the BRO: <br>"
+            f"{' '.join(deregistered_cpt_ids)}. </b>",
+            showarrow=False,
+            font=dict(color="red"),
+            borderwidth=1,
+            bordercolor="black",
+        )
 
     fig.update_yaxes(
         row=1,
@@ -14,7 +14,14 @@ SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
 CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import hashlib
 import json
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 from viktor import UserError
 from viktor.errors import InputViolation
@@ -127,9 +134,48 @@ DEFAULT_ROBERTSON_TABLE = [
 LINE_SCALE = 0.2
 
 
+def get_polygon_hash(geo_polygon) -> str:
+    """
+    Hashes the points of the polygon, so the polygon that the CPTs were retrieved for can be compared to the current one.
+    """
+    points = [[p.lat, p.lon] for p in geo_polygon.points]
+    return hashlib.blake2b(repr(points).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def dump_retrieved_cpts(retrieved_cpts: dict) -> str:
+    """
+    Serializes the retrieved CPTs to the JSON string that is stored in the params, using orjson when it is available.
+    """
+    if orjson is not None:
+        return orjson.dumps(retrieved_cpts).decode("utf-8")
+    return json.dumps(retrieved_cpts)
+
+
+@lru_cache(maxsize=8)
+def parse_retrieved_cpts(retrieved_cpts: str) -> dict:
+    """
+    Parses the retrieved CPTs, which are stored as JSON string in the params.
+    The views, options and validation all parse the same string, so it is only parsed once. The returned dict is shared
+    between those callers and should therefore not be modified.
+    """
+    if orjson is not None:
+        parsed_cpts = orjson.loads(retrieved_cpts)
+    else:
+        parsed_cpts = json.loads(retrieved_cpts)
+
+    # CPTs that were retrieved before they were stored as separate lists
+    if "cpt_ids" in parsed_cpts:
+        cpts = parsed_cpts.pop("cpt_ids")
+        parsed_cpts["bro_ids"] = [cpt["bro_id"] for cpt in cpts]
+        parsed_cpts["lats"] = [float(cpt["lat"]) for cpt in cpts]
+        parsed_cpts["lons"] = [float(cpt["lon"]) for cpt in cpts]
+        parsed_cpts["dates"] = [cpt["date"] for cpt in cpts]
+    return parsed_cpts
+
+
 def _get_cpt_options(params, **kwargs):
     if params.retrieved_cpts:
-        return [OptionListElement(cpt["bro_id"]) for cpt in json.loads(params.retrieved_cpts)["cpt_ids"]]
+        return [OptionListElement(bro_id) for bro_id in parse_retrieved_cpts(params.retrieved_cpts)["bro_ids"]]
     return []
 
 
@@ -148,7 +194,8 @@ def validate_step_1(params, **kwargs):
         raise UserError("No CPTs have been retrieved yet.", input_violations=violations)
 
     if params.retrieved_cpts:
-        if not json.loads(params.retrieved_cpts)["cpt_ids"]:
+        retrieved_cpts = parse_retrieved_cpts(params.retrieved_cpts)
+        if not retrieved_cpts["bro_ids"]:
             violation = [
                 InputViolation(
                     "No CPTs are available. Please draw a larger polygon.",
@@ -167,8 +214,12 @@ def validate_step_1(params, **kwargs):
                 fields=["step_1.retrieve_data"],
             )
         ]
-        new_points = [[p.lat, p.lon] for p in params.step_1.geo_polygon.points]
-        if json.loads(params.retrieved_cpts)["selected_polygon_points"] != new_points:
+        if "polygon_hash" in retrieved_cpts:
+            polygon_changed = retrieved_cpts["polygon_hash"] != get_polygon_hash(params.step_1.geo_polygon)
+        else:  # CPTs that were retrieved before the polygon hash was stored
+            new_points = [[p.lat, p.lon] for p in params.step_1.geo_polygon.points]
+            polygon_changed = retrieved_cpts["selected_polygon_points"] != new_points
+        if polygon_changed:
             raise UserError(
                 "Press 'Retrieve available CPTs' button first to continue.",
                 input_violations=violations,
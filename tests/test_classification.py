@@ -0,0 +1,175 @@
+"""Copyright (c) 2023 VIKTOR B.V.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+VIKTOR B.V. PROVIDES THIS SOFTWARE ON AN "AS IS" BASIS, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NON-INFRINGEMENT. IN NO EVENT
+SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import unittest
+
+from app.bro.classification import IMBROFile
+from app.bro.classification import convert_soil_layout_from_m_to_mm
+from app.bro.classification import convert_soil_layout_from_mm_to_m
+from viktor import Color
+from viktor import UserError
+from viktor.geo import Soil
+from viktor.geo import SoilLayer
+from viktor.geo import SoilLayout
+
+IMBRO_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<dispatchDataResponse xmlns="http://www.broservices.nl/xsd/dscpt/1.1"
+  xmlns:brocom="http://www.broservices.nl/xsd/brocommon/3.0"
+  xmlns:cptcommon="http://www.broservices.nl/xsd/cptcommon/1.1"
+  xmlns:gml="http://www.opengis.net/gml/3.2"
+  xmlns:swe="http://www.opengis.net/swe/2.0">
+  <brocom:responseType>dispatch</brocom:responseType>
+  <dispatchDocument>
+    <CPT_O gml:id="BRO_0001">
+      <brocom:broId>CPT000000012345</brocom:broId>
+      <researchReportDate><brocom:date>2019-04-03</brocom:date></researchReportDate>
+      <deliveredLocation>
+        <cptcommon:location srsName="EPSG:28992"><gml:pos>155000.1 463000.2</gml:pos></cptcommon:location>
+      </deliveredLocation>
+      <deliveredVerticalPosition>
+        <cptcommon:localVerticalReferencePoint codeSpace="x">maaiveld</cptcommon:localVerticalReferencePoint>
+        <cptcommon:offset uom="m">-1.250</cptcommon:offset>
+        <cptcommon:verticalDatum codeSpace="x">NAP</cptcommon:verticalDatum>
+      </deliveredVerticalPosition>
+      <conePenetrometerSurvey>
+        <cptcommon:trajectory>
+          <cptcommon:predrilledDepth uom="m">0.00</cptcommon:predrilledDepth>
+          <cptcommon:finalDepth uom="m">2.00</cptcommon:finalDepth>
+        </cptcommon:trajectory>
+        <cptcommon:conePenetrometer>
+          <cptcommon:conePenetrometerType>F7.5CKEHG/V-1701-1393</cptcommon:conePenetrometerType>
+          <cptcommon:coneSurfaceArea uom="mm2">1500</cptcommon:coneSurfaceArea>
+          <cptcommon:coneSurfaceQuotient>0.80</cptcommon:coneSurfaceQuotient>
+          <cptcommon:coneToFrictionSleeveDistance uom="mm">100</cptcommon:coneToFrictionSleeveDistance>
+          <cptcommon:frictionSleeveSurfaceArea uom="mm2">22530</cptcommon:frictionSleeveSurfaceArea>
+          <cptcommon:frictionSleeveSurfaceQuotient>1.000</cptcommon:frictionSleeveSurfaceQuotient>
+        </cptcommon:conePenetrometer>
+        <cptcommon:conePenetrationTest>
+          <cptcommon:cptResult>
+            <cptcommon:encoding>
+              <swe:TextEncoding blockSeparator=";" decimalSeparator="." tokenSeparator=","/>
+            </cptcommon:encoding>
+            <cptcommon:values>{values}</cptcommon:values>
+          </cptcommon:cptResult>
+        </cptcommon:conePenetrationTest>
+        <cptcommon:parameters>
+          <cptcommon:penetrationLength>ja</cptcommon:penetrationLength>
+          <cptcommon:depth>{depth}</cptcommon:depth>
+          <cptcommon:coneResistance>ja</cptcommon:coneResistance>
+          <cptcommon:localFriction>ja</cptcommon:localFriction>
+          <cptcommon:frictionRatio>ja</cptcommon:frictionRatio>
+          <cptcommon:inclinationNS>nee</cptcommon:inclinationNS>
+        </cptcommon:parameters>
+      </conePenetrometerSurvey>
+    </CPT_O>
+  </dispatchDocument>
+</dispatchDataResponse>
+"""
+# Rows of penetration length, depth, qc, fs and Rf, of which the last two rows are in the wrong order
+IMBRO_XML_VALUES = "0.000,1.200,5.5,0.02,-999999;0.020,1.220,5.6,0.03,1.0;0.010,1.210,-999999,0.025,0.9;"
+
+
+def _get_imbro_file(values: str = IMBRO_XML_VALUES, depth: str = "ja") -> IMBROFile:
+    return IMBROFile(IMBRO_XML.format(values=values, depth=depth).encode("utf-8"))
+
+
+def _convert_soil_layout_by_serialization(soil_layout: SoilLayout, factor: float) -> SoilLayout:
+    """The original conversion, which scales the layers of the serialized SoilLayout."""
+    serialization_dict = soil_layout.serialize()
+    for layer in serialization_dict["layers"]:
+        layer["top_of_layer"] = layer["top_of_layer"] * factor
+        layer["bottom_of_layer"] = layer["bottom_of_layer"] * factor
+    return SoilLayout.from_dict(serialization_dict)
+
+
+class TestConvertSoilLayout(unittest.TestCase):
+    def setUp(self):
+        sand = Soil("Robertson zone 6", Color(255, 225, 178), properties={"ui_name": "Sand", "phi": 27})
+        clay = Soil("Robertson zone 3", Color(29, 118, 29), properties={"ui_name": "Clay", "phi": 17.5})
+        self.soil_layout_in_mm = SoilLayout(
+            [
+                SoilLayer(sand, 1250, -1500.5, properties={"note": "top"}),
+                SoilLayer(clay, -1500.5, -4333),
+                SoilLayer(sand, -4333, -10001.25, properties={"note": "bottom"}),
+            ]
+        )
+        self.soil_layout_in_m = _convert_soil_layout_by_serialization(self.soil_layout_in_mm, 1 / 1000)
+
+    def test_convert_soil_layout_from_mm_to_m(self):
+        expected = _convert_soil_layout_by_serialization(self.soil_layout_in_mm, 1 / 1000)
+        result = convert_soil_layout_from_mm_to_m(self.soil_layout_in_mm)
+        self.assertEqual(result.serialize(), expected.serialize())
+
+    def test_convert_soil_layout_from_m_to_mm(self):
+        expected = _convert_soil_layout_by_serialization(self.soil_layout_in_m, 1000)
+        result = convert_soil_layout_from_m_to_mm(self.soil_layout_in_m)
+        self.assertEqual(result.serialize(), expected.serialize())
+
+    def test_convert_soil_layout_keeps_original(self):
+        original = self.soil_layout_in_mm.serialize()
+        convert_soil_layout_from_mm_to_m(self.soil_layout_in_mm)
+        self.assertEqual(self.soil_layout_in_mm.serialize(), original)
+
+
+class TestIMBROFile(unittest.TestCase):
+    def test_parse_headers(self):
+        headers = _get_imbro_file().parse()["headers"]
+        self.assertEqual(
+            headers,
+            {
+                "name": "CPT000000012345",
+                "gef_file_date": "2019-04-03",
+                "height_system": "NAP",
+                "fixed_horizontal_level": "maaiveld",
+                "ground_level_wrt_reference_m": -1.25,
+                "ground_level_wrt_reference": -1250.0,
+                "excavation_depth": "0.00",
+                "corrected_depth": 2000.0,
+                "x_y_coordinates": [155000.1, 463000.2],
+                "cone_type": "F7.5CKEHG/V-1701-1393",
+                "cone_tip_area": 1500.0,
+                "friction_sleeve_area": 22530.0,
+                "surface_area_quotient_tip": 0.8,
+                "surface_area_quotient_friction_sleeve": 1.0,
+                "distance_cone_to_centre_friction_sleeve": 100.0,
+            },
+        )
+
+    def test_parse_measurement_data(self):
+        cpt_dict = _get_imbro_file().parse()
+        measurement_data = cpt_dict["measurement_data"]
+        self.assertIsNone(cpt_dict["warning_msg"])
+        # Sorted on depth, relative to the ground level of -1.25 m
+        self.assertEqual(measurement_data["elevation"], [-2450, -2460, -2470])
+        self.assertEqual(measurement_data["corrected_depth"], [1200, 1210, 1220])
+        # Missing values become None
+        self.assertEqual(measurement_data["qc"], [5.5, None, 5.6])
+        self.assertEqual(measurement_data["fs"], [0.02, 0.025, 0.03])
+        self.assertIsNone(measurement_data["Rf"][0])
+        self.assertAlmostEqual(measurement_data["Rf"][1], 0.009)
+        self.assertAlmostEqual(measurement_data["Rf"][2], 0.01)
+
+    def test_parse_without_depth_uses_penetration_length(self):
+        values = "0.000,-999999,5.5,0.02,0.5;0.020,-999999,5.6,0.03,1.0;0.010,-999999,5.7,0.025,0.9;"
+        cpt_dict = _get_imbro_file(values=values, depth="nee").parse()
+        self.assertEqual(cpt_dict["warning_msg"], "Penetration length used as elevation as data was missing")
+        self.assertEqual(cpt_dict["measurement_data"]["elevation"], [-1250, -1260, -1270])
+        self.assertEqual(cpt_dict["measurement_data"]["qc"], [5.5, 5.7, 5.6])
+
+    def test_parse_without_values(self):
+        for values in ("", ";", "  "):
+            with self.subTest(values=values), self.assertRaises(UserError):
+                _get_imbro_file(values=values).parse()